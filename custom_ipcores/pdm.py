@@ -9,12 +9,9 @@ import sys
 import math
 import random
 import struct
+import functools
 
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.ticker as mtick
-import scipy.fftpack
-from scipy.fftpack import fft,fftshift
 
 sys.path.append('../')
 
@@ -34,25 +31,105 @@ pi = 3.141592653589793
 
 # Functions ----------------------------------------------------------------
 
-def pdm(x):
-    n = len(x)
-    y = np.zeros(n)
-    error = np.zeros(n+1)
+def _pdm_core(x, y, error):
+    # Keep the accumulated error in a local scalar, error[i] is the error
+    # seen by sample i (before it is quantized). An empty error array skips
+    # storing it.
+    store_error = error.shape[0] != 0
+    e = 0.0
+    for i in range(x.shape[0]):
+        xi = x[i]
+        if store_error:
+            error[i] = e
+        # Branchless quantizer, the comparison result is cast to 0.0/1.0
+        yi = np.float64(xi >= e)
+        y[i] = yi
+        e = yi - xi + e
+
+_pdm_core_jit = None
+
+def _get_pdm_core():
+    # Numba is optional and only imported when pdm() is actually used, so
+    # that building the gateware does not pay for it. The kernel is not
+    # cached on disk: the cache records the importing module name, which
+    # differs between "import pdm" and "import custom_ipcores.pdm".
+    global _pdm_core_jit
+    if _pdm_core_jit is None:
+        try:
+            from numba import njit
+            _pdm_core_jit = njit(_pdm_core)
+        except ImportError:
+            _pdm_core_jit = _pdm_core
+    return _pdm_core_jit
+
+def pdm(x, return_error=False):
+    x     = np.ascontiguousarray(x, dtype=np.float64)
+    n     = len(x)
+    y     = np.empty(n, dtype=np.float64)
+    error = np.empty(n if return_error else 0, dtype=np.float64)
 
     print("n = " + str(n))
 
-    for i in range(n):
-
-        if x[i] >= error[i]:
-            y[i] = 1
-        else:
-            y[i] = 0
-
-        error[i+1] = y[i] - x[i] + error[i]
-
-    return y, error[0:n]
+    _get_pdm_core()(x, y, error)
+
+    return y, (error if return_error else None)
+
+@functools.lru_cache(maxsize=None)
+def _cic_params(M, R, W):
+    # Register width of a M stages, R decimation CIC filter with W bit input
+    # and the matching signed range
+    nbit = W + math.ceil(M * math.log2(R))
+    MIN  = -(1 << (nbit-1))
+    MAX  = (1 << (nbit-1)) - 1
+    return nbit, MIN, MAX
+
+def _down_counter(period):
+    # Signed shape of a down counter loaded with period-2 that ends its period
+    # when it reaches -1 (sign bit set). With period == 1 the reset value is
+    # already -1, so the counter reloads -1 and fires on every cycle.
+    assert period >= 1
+    return (bits_for(max(period-2, 0)) + 1, True)
+
+@functools.lru_cache(maxsize=None)
+def _cic_pruning(M, R, lsb_drop):
+    # Hogenauer register pruning: number of LSBs that can be discarded at
+    # the input of each of the 2M stages (integrators then combs) when the
+    # lsb_drop LSBs of the output are thrown away anyway. The truncation
+    # noise of every stage then stays below the one of the output.
+    F2 = []
+    for j in range(1, M+1):
+        f2 = 0
+        for k in range((R-1)*M + j):
+            h = sum((-1)**l * math.comb(M, l) * math.comb(M - j + k - R*l, k - R*l) for l in range(k//R + 1))
+            f2 += h * h
+        F2.append(f2)
+    for j in range(M+1, 2*M+1):
+        F2.append(math.comb(2*(2*M+1-j), 2*M+1-j))
+
+    lsb  = []
+    prev = 0
+    for f2 in F2:
+        b = math.floor(lsb_drop - 0.5*math.log2(f2) - 0.5*math.log2(2*M))
+        # Never prune more than the output, never less than the previous stage
+        b = min(max(b, prev), lsb_drop)
+        lsb.append(b)
+        prev = b
+    return tuple(lsb)
+
+def spectrum(x, NFFT, fs):
+    # The input is real so only the non-redundant half is computed, the
+    # negative frequencies are rebuilt from the Hermitian symmetry to give
+    # the same two-sided (fftshift'ed) spectrum as fft()
+    from scipy.fft import rfft
+    Xr    = rfft(x, n=NFFT)
+    X     = np.concatenate((np.conj(Xr[NFFT//2:0:-1]), Xr[:(NFFT+1)//2]))
+    fVals = np.arange(start = -(NFFT//2), stop = (NFFT+1)//2)*fs/NFFT # DFT Sample points
+    return fVals, X
 
 def plot_demo_pdm():
+    # Plotting is only needed here, keep it out of the gateware build
+    import matplotlib.pyplot as plt
+
     # Run simulation by software
     n = 100
     fclk = 250e6 # clock frequency (Hz)
@@ -60,7 +137,7 @@ def plot_demo_pdm():
     f_sin = 5e6 # sine frequency (Hz)
 
     x = 0.5 + 0.4 * np.sin(2*np.pi*f_sin*t)
-    y, error = pdm(x)
+    y, error = pdm(x, return_error=True)
 
     plt.plot(1e9*t, x, label='input signal')
     plt.step(1e9*t, y, label='pdm signal',  linewidth=2.0)
@@ -123,7 +200,7 @@ class EdgeDetector(Module):
 #                             ___             ___             ___             ___             ___
 #           fs      _________|   |___________|   |____...____|   |___________|   |___________|   |_______
 #                                ↑               ↑               ↑               ↑               ↑
-#                       cnt      0               1              R-1              0               1
+#                       cnt     R-2             R-3              -1             R-2             R-3
 #                                    sample[0]       sample[1]       sample[R-1]
 #                                                                                 ___
 #           shift_2 _____________________________________________________________|   |_______________
@@ -132,15 +209,23 @@ class EdgeDetector(Module):
 #                                                                                    ↑
 #                                                                               valid output
 #
+# Note: integrator stage i is updated i+1 cycles after fs (once buff holds the new sample), shift_2 and
+#       valid come M cycles later than drawn. The output samples themselves are unchanged.
+#
 ###################################################################################################################
 
 class CIC_FILTER(Module):
-    def __init__(self, M=5, R=64, W=8):
+    def __init__(self, M=5, R=64, W=8, lsb_drop=0):
 
         # Caculate nbit
-        nbit = W + math.ceil(M * math.log2(R))
-        MIN  = -1 * pow(2, nbit - 1)
-        MAX  = pow(2, nbit-1) - 1
+        nbit, MIN, MAX = _cic_params(M, R, W)
+
+        # Pruned LSBs and width of each stage, lsb_drop is the number of output
+        # LSBs the user discards (0: full precision, no pruning). At least the
+        # MSB of every stage is kept.
+        lsb_drop = min(lsb_drop, nbit - 1)
+        lsb   = _cic_pruning(M, R, lsb_drop)
+        width = [nbit - b for b in lsb]
 
         # Interface
         self.input  = input  = Signal(min=MIN, max=MAX)
@@ -148,35 +233,67 @@ class CIC_FILTER(Module):
         self.fs     = fs     = Signal()
         self.valid  = valid  = Signal()
 
-        cnt   = Signal(max=R+1)
+        cnt   = Signal(_down_counter(R), reset=R-2) # down counter, R-th sample when negative
         ena   = Signal()
         buff  = Signal(min=MIN, max=MAX)
 
-        intg = Array(Signal(min=MIN, max=MAX) for i in range(M))
-        di   = Array(Signal(min=MIN, max=MAX) for i in range(M))
-        comb = Array(Signal(min=MIN, max=MAX) for i in range(M))
-        dc   = Array(Signal(min=MIN, max=MAX) for i in range(M))
+        # All stages of a kind are packed into one vector, stage i being the
+        # next width[i] bits. The slices are unsigned but every stage keeps
+        # the same MSB and is truncated back to its width, so the two's
+        # complement (modulo) arithmetic of the filter is unchanged.
+        # Only kinds driven from a single domain can be packed: comb[0] is
+        # the (sync) decimator register while comb[1:] are combinatorial, so
+        # comb stays one Signal per stage.
+        intg_vec = Signal(sum(width[:M]))
+        di_vec   = Signal(sum(width[:M]))
+        dc_vec   = Signal(sum(width[M:]))
+        out      = Signal(width[2*M-1])
+
+        def stages(vec, widths):
+            offset = 0
+            for w in widths:
+                yield vec[offset:offset+w]
+                offset += w
+
+        intg = list(stages(intg_vec, width[:M]))
+        di   = list(stages(di_vec,   width[:M]))
+        comb = [Signal(w) for w in width[M:]]
+        dc   = list(stages(dc_vec,   width[M:]))
+
+        # LSBs to drop from the previous stage at the input of stage j
+        drop = [lsb[0]] + [lsb[j] - lsb[j-1] for j in range(1, 2*M)]
+
+        # The integrators are pipelined, stage i is updated by fs delayed by
+        # i+1 cycles from the (already updated) register of stage i-1, so each
+        # adder sits between two registers instead of rippling through all M
+        # stages. Stage 0 waits one cycle for buff to hold the new sample, so
+        # the decimator still picks the same samples. The decimator ena is
+        # delayed to match (M cycles).
+        fs_d  = [fs]  + [Signal() for i in range(M)]
+        ena_d = [ena] + [Signal() for i in range(M)]
 
         print("nbit = " + str(len(input)))
+        print("lsb  = " + str(lsb))
 
         self.comb += [
-            intg[0].eq(buff + di[0]),
-            output.eq(comb[M-1] - dc[M-1]),
+            intg[0].eq(buff[drop[0]:] + di[0]),
+            out.eq(comb[M-1] - dc[M-1]),
+            output.eq(out << lsb[2*M-1]),
         ]
 
         self.sync += [
-            valid.eq(ena),
-            If(ena,
-                comb[0].eq(intg[M-1])
+            valid.eq(ena_d[M]),
+            If(ena_d[M],
+                comb[0].eq(di[M-1][drop[M]:])
             ),
             If(fs,
                 buff.eq(input),
-                If(cnt < (R-1),
-                    cnt.eq(cnt + 1),
-                    ena.eq(0)
-                ).Else( # cnt == (R-1)
+                If(cnt[-1], # cnt == -1
                     ena.eq(1),
-                    cnt.eq(0)
+                    cnt.eq(R-2)
+                ).Else(
+                    cnt.eq(cnt - 1),
+                    ena.eq(0)
                 ),
             ).Else(
                 ena.eq(0)
@@ -184,12 +301,68 @@ class CIC_FILTER(Module):
         ]
 
         for i in range(M):
-            self.sync += If(fs, di[i].eq(intg[i]))
-            self.sync += If(ena, dc[i].eq(comb[i]))
+            self.sync += If(fs_d[i+1], di[i].eq(intg[i]))
+            self.sync += If(ena_d[M], dc[i].eq(comb[i]))
+            self.sync += fs_d[i+1].eq(fs_d[i])
+            self.sync += ena_d[i+1].eq(ena_d[i])
 
         for i in range(1, M):
-            self.comb += intg[i].eq(intg[i-1] + di[i])
-            self.comb += comb[i].eq(comb[i-1] - dc[i-1])
+            self.comb += intg[i].eq(di[i-1][drop[i]:] + di[i])
+            self.comb += comb[i].eq(comb[i-1][drop[M+i]:] - dc[i-1][drop[M+i]:])
+
+# Cached CIC filter ------------------------------------------------------------
+
+@functools.lru_cache(maxsize=16)
+def _cic_verilog(M, R, W, lsb_drop):
+    # Elaborate the CIC filter once per (M, R, W, lsb_drop) and keep its
+    # Verilog text, the ports are renamed so the black box below can wire
+    # them by name
+    cic = CIC_FILTER(M=M, R=R, W=W, lsb_drop=lsb_drop)
+    cic.input.name_override  = "cic_input"
+    cic.output.name_override = "cic_output"
+    cic.fs.name_override     = "cic_fs"
+    cic.valid.name_override  = "cic_valid"
+    # The wildcard litex imports bind verilog to litex.gen.fhdl.verilog, which
+    # does not create missing clock domains, so give the filter its own sys
+    # domain and export its clock/reset as ports
+    cic.clock_domains.cd_sys = cd_sys = ClockDomain("sys")
+    name = "cic_M{}_R{}_W{}_L{}".format(M, R, W, lsb_drop)
+    ios  = {cic.input, cic.output, cic.fs, cic.valid, cd_sys.clk, cd_sys.rst}
+    return str(verilog.convert(cic, ios=ios, name=name)), name
+
+class CIC_FILTER_BLACKBOX(Module):
+    def __init__(self, platform, M=5, R=64, W=8, lsb_drop=0, build_dir="build"):
+
+        # Caculate nbit
+        nbit, MIN, MAX = _cic_params(M, R, W)
+
+        # Interface, same as CIC_FILTER
+        self.input  = input  = Signal(min=MIN, max=MAX)
+        self.output = output = Signal(min=MIN, max=MAX)
+        self.fs     = fs     = Signal()
+        self.valid  = valid  = Signal()
+
+        text, name = _cic_verilog(M, R, W, min(lsb_drop, nbit - 1))
+
+        os.makedirs(build_dir, exist_ok=True)
+        filename = os.path.join(build_dir, name + ".v")
+        with open(filename, "w") as f:
+            f.write(text)
+        platform.add_source(filename)
+
+        # ResetSignal lowers to a constant 0 on a reset less sys domain, which
+        # can not be wired to an Instance port directly
+        rst = Signal()
+        self.comb += rst.eq(ResetSignal("sys", allow_reset_less=True))
+
+        self.specials += Instance(name,
+            i_sys_clk  = ClockSignal("sys"),
+            i_sys_rst  = rst,
+            i_cic_input  = input,
+            i_cic_fs     = fs,
+            o_cic_output = output,
+            o_cic_valid  = valid,
+        )
 
 ###################################################################################################################
 #
@@ -212,7 +385,7 @@ class CIC_FILTER(Module):
 #                        _   _   _   _   _   _   _   _   _   _   _   _   _   _   _   _   _   _   _   _
 #    sys_clk           _| |_| |_| |_| |_| |_| |_| |_| |_| |_| |_| |_| |_| |_| |_| |_| |_| |_| |_| |_| |_
 #                           ↑   ↑           ↑
-#                      cnt  0   1 ...      N-1
+#                      cnt N-2 N-3 ...      -1
 #                            ___             ___             ___             ___             ___
 #    fs                _____|   |___________|   |___________|   |___________|   |___________|   |_______
 #                            _______         _______         _______         _______         _______
@@ -225,16 +398,16 @@ class CIC_FILTER(Module):
 ###################################################################################################################
 
 class PDM_TO_PCM(Module):
-    def __init__(self, sys_clk_freq=100e3, fs_in=1e3, M=3, R=64, dw=16, scale_factor=100, pdm_clk_drive_f=True):
+    def __init__(self, sys_clk_freq=100e3, fs_in=1e3, M=3, R=64, dw=16, scale_factor=100, pdm_clk_drive_f=True, platform=None, build_dir="build"):
 
         # Caculate nbit
-        nbit    = 1 + math.ceil(M * math.log2(R))
-        MIN     = -1 * pow(2, nbit - 1)
-        MAX     = pow(2, nbit-1) - 1
-        I2S_MIN = -1 * pow(2, dw - 1)
-        I2S_MAX = pow(2, dw-1) - 1
-        N       = int(sys_clk_freq/fs_in)
-        K       = int((N*R)/(4*dw))
+        nbit, MIN, MAX = _cic_params(M, R, 1)
+        I2S_MIN = -(1 << (dw-1))
+        I2S_MAX = (1 << (dw-1)) - 1
+        # Periods below one cycle behave as one cycle (as the up counters did)
+        N       = max(int(sys_clk_freq/fs_in), 1)
+        K       = max(int((N*R)/(4*dw)), 1)
+        shift   = math.ceil(math.log2(scale_factor)) # output LSBs dropped
 
         print("N = " + str(N))
         print("K = " + str(N))
@@ -253,16 +426,27 @@ class PDM_TO_PCM(Module):
         self.buff    = buff     = Signal(min=I2S_MIN, max=I2S_MAX)
 
         # Modules
-        self.submodules.cic = cic = CIC_FILTER(M=M, R=R, W=1)
+        if platform is None:
+            # Simulation, keep the CIC filter signals visible to the testbench
+            self.submodules.cic = cic = CIC_FILTER(M=M, R=R, W=1, lsb_drop=shift)
+        else:
+            # Build, reuse the cached CIC filter Verilog (written to build_dir)
+            self.submodules.cic = cic = CIC_FILTER_BLACKBOX(platform, M=M, R=R, W=1, lsb_drop=shift, build_dir=build_dir)
         self.submodules.edt = edt = ResetInserter()(EdgeDetector())
 
+        # Scaled CIC output, a plain bit select when the dw bits fit in the
+        # CIC output, else an arithmetic shift to sign extend
+        if shift + dw <= len(cic.output):
+            pcm = cic.output[shift:shift+dw]
+        else:
+            pcm = cic.output >> shift
+
         # Internal signals
-        buff_r        = Signal(min=I2S_MIN, max=I2S_MAX)
-        buff_l        = Signal(min=I2S_MIN, max=I2S_MAX)
-        is_right_chan = Signal()
-        cnt           = Signal(max=N+1)
-        br_cnt        = Signal(max=K+1)
-        pulse_cnt     = Signal(8)
+        buff_sr       = Signal(dw) # I2S shift register, shared by both channels
+        # Down counters, the period ends when the sign bit is set
+        cnt           = Signal(_down_counter(N), reset=N-2)
+        br_cnt        = Signal(_down_counter(K), reset=K-2)
+        pulse_cnt     = Signal(_down_counter(2*dw), reset=2*dw-2)
         i2s_pulse_ena = Signal()
         pdm_clk_drive = Signal()
 
@@ -282,47 +466,33 @@ class PDM_TO_PCM(Module):
             edt.i.eq(i2s_sck),
             cic.input[0].eq(pdm_dat),
             cic.fs.eq(fs),
-            If(is_right_chan,
-                i2s_so.eq(buff_r[dw-1]), # MSB
-            ).Else(
-                i2s_so.eq(buff_l[dw-1]), # MSB
-            )
+            i2s_so.eq(buff_sr[dw-1]), # MSB
         ]
 
         self.sync += [
             If(cic.valid,
-                buff.eq(cic.output >> math.ceil(math.log2(scale_factor))),
+                buff.eq(pcm),
                 i2s_pulse_ena.eq(1),
             ),
 
             If(i2s_pulse_ena,
-                If(br_cnt < (K-1),
-                    br_cnt.eq(br_cnt + 1),
+                If(~br_cnt[-1],
+                    br_cnt.eq(br_cnt - 1),
                 ).Else(
                     i2s_sck.eq(~i2s_sck),
-                    br_cnt.eq(0),
-                    If(pulse_cnt < 2*dw-1,
-                        pulse_cnt.eq(pulse_cnt + 1),
+                    br_cnt.eq(K-2),
+                    If(~pulse_cnt[-1],
+                        pulse_cnt.eq(pulse_cnt - 1),
                     ).Else(
                         i2s_ws.eq(~i2s_ws),
-                        pulse_cnt.eq(0),
+                        pulse_cnt.eq(2*dw-2),
                     )
                 ),
                 If(edt.f,
-                    If(pulse_cnt == 2,
-                        If(i2s_ws,
-                            buff_r.eq(buff),
-                            is_right_chan.eq(1)
-                        ).Else(
-                            buff_l.eq(buff),
-                            is_right_chan.eq(0)
-                        )
+                    If(pulse_cnt == (2*dw-4), # 3rd pulse of the channel
+                        buff_sr.eq(buff),
                     ).Else(
-                        If(is_right_chan,
-                            buff_r.eq(buff_r << 1),
-                        ).Else(
-                            buff_l.eq(buff_l << 1),
-                        )
+                        buff_sr.eq(buff_sr << 1),
                     )
                 ),
             )
@@ -330,16 +500,16 @@ class PDM_TO_PCM(Module):
 
         self.sync += [
             If(ena,
-                If(cnt < (N-1),
-                    cnt.eq(cnt + 1),
+                If(~cnt[-1],
+                    cnt.eq(cnt - 1),
                     fs.eq(0),
-                    If(cnt == (int(N/2)-1),
+                    If(cnt == (N-1-int(N/2)),
                         pdm_clk_drive.eq(0),
                     )
                 ).Else(
                     fs.eq(1),
                     pdm_clk_drive.eq(1),
-                    cnt.eq(0)
+                    cnt.eq(N-2)
                 )
             ).Else(
                 fs.eq(0),
@@ -351,8 +521,11 @@ class PDM_TO_PCM(Module):
 # Test bench functions -----------------------------------------------------
 
 def CIC_FILTER_TB(dut):
+    # Plotting is only needed here, keep it out of the gateware build
+    import matplotlib.pyplot as plt
+    from scipy.fft import next_fast_len
 
-    np.random.seed(0xBABECAFE)
+    rng = np.random.default_rng(0xBABECAFE)
 
     # CIC filter parameters
     M = 3  # number of stage
@@ -383,8 +556,18 @@ def CIC_FILTER_TB(dut):
     # Number of fclk cycle
     J = (N + 1) * K
 
-    signal_in = []
-    signal_out = []
+    # Calculate input signal, one sample per fs pulse
+    t  = np.arange(N + 1) * T
+    signal_in  = 10.0 * rng.uniform(-1.0, 1.0, size=N + 1) # noise
+    signal_in += a * np.sin(2.0 * np.pi * f1 * t)
+    signal_in += a * np.sin(2.0 * np.pi * f2 * t)
+    signal_in += a * np.sin(2.0 * np.pi * f3 * t)
+    signal_in += a * np.sin(2.0 * np.pi * f4 * t)
+
+    # At most one output sample every R input samples
+    signal_out = np.empty(N // R + 4, dtype=np.float64)
+    j = 0
+    inv_gain = 1.0 / gain
 
     cnt = 0
     i = 0
@@ -395,32 +578,27 @@ def CIC_FILTER_TB(dut):
             yield dut.fs.eq(0)
         else:
             cnt = 0
-            # Calculate input signal
-            f = 0
-            f += 10 * random.randint(-10000 , 10000) / 10000 # noise
-            f += a * np.sin(2.0 * np.pi * f1 * i * T)
-            f += a * np.sin(2.0 * np.pi * f2 * i * T)
-            f += a * np.sin(2.0 * np.pi * f3 * i * T)
-            f += a * np.sin(2.0 * np.pi * f4 * i * T)
+            f = signal_in[i]
             i = i + 1
-            signal_in.append(f)
             yield dut.fs.eq(1)
             yield dut.input.eq(int(f))
 
         if (yield dut.valid) == 1:
             output = yield dut.output
-            signal_out.append(output/gain)
+            signal_out[j] = output * inv_gain
+            j = j + 1
         yield
 
-    NFFT = len(signal_in) # NFFT-point DFT
+    signal_out = signal_out[:j]
+
+    NFFT = next_fast_len(len(signal_in), real=True) # NFFT-point DFT, zero padded to a fast size
     print("fs = " + str(fs_in))
     print("NFFT = " + str(NFFT))
     FL = -120e3
     FH = 120e3
     STEP = 20e3
-    X = fftshift(fft(signal_in, NFFT)) # compute DFT using FFT
+    fVals, X = spectrum(signal_in, NFFT, fs_in) # compute DFT using FFT
     fig, ax = plt.subplots(nrows=1, ncols=1) # create figure handle
-    fVals = np.arange(start = -NFFT/2, stop = NFFT/2)*fs_in/NFFT # DFT Sample points
     ax.plot(fVals, np.abs(X))
     ax.set_title('Frequency domain input signal')
     ax.set_xlabel('Normalized Frequency(Hz)')
@@ -430,16 +608,15 @@ def CIC_FILTER_TB(dut):
     ax.set_xticks(np.arange(FL, FH + STEP, STEP))
     plt.grid()
 
-    NFFT = len(signal_out) # NFFT-point DFT
+    NFFT = next_fast_len(len(signal_out), real=True) # NFFT-point DFT, zero padded to a fast size
     fs = int(fs_in/R)
     print("fs = " + str(fs))
     print("NFFT = " + str(NFFT))
     FL = -1*int(fs/2)
     FH = int(fs/2)
     STEP = 1e3
-    X = fftshift(fft(signal_out, NFFT)) # compute DFT using FFT
+    fVals, X = spectrum(signal_out, NFFT, fs) # compute DFT using FFT
     fig, ax = plt.subplots(nrows=1, ncols=1) # create figure handle
-    fVals = np.arange(start = -NFFT/2, stop = NFFT/2)*fs/NFFT # DFT Sample points
     ax.plot(fVals, np.abs(X))
     ax.set_title('Frequency domain output signal')
     ax.set_xlabel('Normalized Frequency(Hz)')
@@ -452,6 +629,10 @@ def CIC_FILTER_TB(dut):
     plt.show()
 
 def PDM_TO_PCM_TB(dut, sys_clk_freq=100e3, fs_in=1e3, M=3, R=64, dw=16, scale_factor=100):
+    # Plotting is only needed here, keep it out of the gateware build
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as mtick
+    from scipy.fft import next_fast_len
 
     print("Running simulation, please be patient!")
 
@@ -485,29 +666,45 @@ def PDM_TO_PCM_TB(dut, sys_clk_freq=100e3, fs_in=1e3, M=3, R=64, dw=16, scale_fa
     x += 0.2 * np.sin(2.0 * np.pi * f2 * t)
     x += 0.2 * np.sin(2.0 * np.pi * f3 * t)
     x += 0.2 * np.sin(2.0 * np.pi * f4 * t)
-    y, error = pdm(x)
+    y, _ = pdm(x)
+    y_bits = y.astype(np.uint8)
 
-    signal_out = []
+    # At most one output sample every R input samples
+    signal_out = np.empty(N // R + 4, dtype=np.float64)
+    j = 0
     i = 0
+    inv_scale_factor = 1.0 / scale_factor
+
+    # fs is periodic with K cycles, once a pulse has been seen there is no
+    # need to poll it again for the next K-1 cycles. cic.valid still has to
+    # be sampled on every cycle.
+    fs      = dut.fs
+    valid   = dut.cic.valid
+    output  = dut.cic.output
+    pdm_eq  = dut.pdm_dat.eq
+    k_idle  = K - 1
+    idle    = 0
 
     for cycle in range(J):
 
         if cycle == 1:
             yield dut.ena.eq(1)
 
-        if (yield dut.fs) == 1:
-            if y[i] != 0:
-                yield dut.pdm_dat.eq(1)
-            else:
-                yield dut.pdm_dat.eq(0)
+        if idle > 0:
+            idle = idle - 1
+        elif (yield fs) == 1:
+            yield pdm_eq(int(y_bits[i]))
             i = i + 1
+            idle = k_idle
 
-        if (yield dut.cic.valid) == 1:
-            output = yield dut.cic.output
-            signal_out.append(output/scale_factor)
+        if (yield valid) == 1:
+            signal_out[j] = (yield output) * inv_scale_factor
+            j = j + 1
 
         yield
 
+    signal_out = signal_out[:j]
+
     # Display time domain signal input
     L = len(y)
     fig, ax = plt.subplots(nrows=1, ncols=1) # create figure handle
@@ -538,15 +735,15 @@ def PDM_TO_PCM_TB(dut, sys_clk_freq=100e3, fs_in=1e3, M=3, R=64, dw=16, scale_fa
     NFFT = len(y) # NFFT-point DFT
     if NFFT >= 512:
         NFFT = 512
+    NFFT = next_fast_len(NFFT, real=True) # zero padded to a fast size
     fs = int(fs_in)
     print("fs = " + str(fs))
     print("NFFT = " + str(NFFT))
     FL = -1*int(fs/2)
     FH = int(fs/2)
     STEP = 200e3
-    X = fftshift(fft(y, NFFT)) # compute DFT using FFT
+    fVals, X = spectrum(y, NFFT, fs) # compute DFT using FFT
     fig, ax = plt.subplots(nrows=1, ncols=1) # create figure handle
-    fVals = np.arange(start = -NFFT/2, stop = NFFT/2)*fs/NFFT # DFT Sample points
     ax.plot(fVals, np.abs(X), 'tab:blue')
     ax.set_title('Frequency domain input signal')
     ax.set_xlabel('Normalized Frequency(Hz)')
@@ -558,16 +755,15 @@ def PDM_TO_PCM_TB(dut, sys_clk_freq=100e3, fs_in=1e3, M=3, R=64, dw=16, scale_fa
     plt.grid()
 
     # Display frequency domain signal output
-    NFFT = len(signal_out) # NFFT-point DFT
+    NFFT = next_fast_len(len(signal_out), real=True) # NFFT-point DFT, zero padded to a fast size
     fs = int(fs_in/R)
     print("fs = " + str(fs))
     print("NFFT = " + str(NFFT))
     FL = -1*int(fs/2)
     FH = int(fs/2)
     STEP = 10e3
-    X = fftshift(fft(signal_out, NFFT)) # compute DFT using FFT
+    fVals, X = spectrum(signal_out, NFFT, fs) # compute DFT using FFT
     fig, ax = plt.subplots(nrows=1, ncols=1) # create figure handle
-    fVals = np.arange(start = -NFFT/2, stop = NFFT/2)*fs/NFFT # DFT Sample points
     ax.plot(fVals, np.abs(X), 'tab:red')
     ax.set_title('Frequency domain output signal')
     ax.set_xlabel('Normalized Frequency(Hz)')
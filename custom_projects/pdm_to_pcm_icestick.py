@@ -82,7 +82,7 @@ class CRG(Module):
         platform.add_period_constraint(self.cd_sys.clk, 1e9/48e6)
 
 class Demo(Module):
-    def __init__(self, platform):
+    def __init__(self, platform, build_dir="build"):
 
         self.submodules.crg = crg = CRG(platform)
 
@@ -91,7 +91,7 @@ class Demo(Module):
         pdm_pads = platform.request("pdm", 0)
 
         # pdm to pcm module
-        self.submodules.pdm_pcm = pdm_pcm = PDM_TO_PCM(sys_clk_freq=48e6, fs_in=2400e3, M=5, R=50, dw=16, scale_factor=6e3)
+        self.submodules.pdm_pcm = pdm_pcm = PDM_TO_PCM(sys_clk_freq=48e6, fs_in=2400e3, M=5, R=50, dw=16, scale_factor=6e3, platform=platform, build_dir=build_dir)
 
         # Connect the I2S IOs
         self.comb += [
@@ -121,7 +121,7 @@ def main():
         build_name="icestick"
         platform = icestick.Platform(toolchain="icestorm")
         platform.add_extension(_ext_io)
-        dut = Demo(platform)
+        dut = Demo(platform, build_dir=build_dir)
         platform.build(dut, build_dir=build_dir, build_name=build_name)
 
     if args.load: